@@ -24,7 +24,7 @@ import re
 import shutil
 from contextlib import ContextDecorator
 from pathlib import Path
-from typing import Dict, List, Optional, Set, Tuple
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
 import apt
 import apt.cache
@@ -87,8 +87,15 @@ class AptCache(ContextDecorator):
         self.stage_cache_arch = stage_cache_arch
         self.progress: Optional[LogProgress] = None
 
-    # pylint: disable=attribute-defined-outside-init
     def __enter__(self) -> AptCache:
+        self._open()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.cache.close()
+
+    # pylint: disable=attribute-defined-outside-init
+    def _open(self) -> None:
         if self.stage_cache is not None:
             self.progress = LogProgress()
             self._populate_stage_cache_dir()
@@ -97,12 +104,17 @@ class AptCache(ContextDecorator):
             # Setting rootdir="/" is needed otherwise the previously set rootdir will
             # be used and _deb.get_installed_packages() will return an empty list.
             self.cache = apt.cache.Cache(rootdir="/")
-        return self
 
     # pylint: enable=attribute-defined-outside-init
 
-    def __exit__(self, *exc) -> None:
+    def refresh(self) -> None:
+        """Reopen the cache to pick up changes made to the system."""
         self.cache.close()
+        self._open()
+
+    def clear_marks(self) -> None:
+        """Discard all changes marked in the cache."""
+        self.cache.clear()
 
     @classmethod
     def configure_apt(cls, application_package_name: str) -> None:
@@ -228,14 +240,17 @@ class AptCache(ContextDecorator):
                 return installed.version
         return None
 
-    def fetch_archives(self, download_path: Path) -> List[Tuple[str, str, Path]]:
+    def fetch_archives(self, download_path: Path) -> Iterator[Tuple[str, str, Path]]:
         """Retrieve packages marked to be fetched.
 
+        Packages are downloaded as the iterator is consumed, so callers can
+        process each archive while the next one is being fetched.
+
         :param download_path: The directory to download files to.
 
-        :return: A list of (<package-name>, <package-version>, <dl-path>) tuples.
+        :return: An iterator of (<package-name>, <package-version>, <dl-path>)
+            tuples.
         """
-        downloaded = []
         for package in self.cache.get_changes():
             if package.candidate is None:
                 continue
@@ -250,8 +265,7 @@ class AptCache(ContextDecorator):
             if package.candidate is None:
                 raise errors.PackageNotFound(package.name)
 
-            downloaded.append((package.name, package.candidate.version, Path(dl_path)))
-        return downloaded
+            yield package.name, package.candidate.version, Path(dl_path)
 
     def get_installed_packages(self) -> Dict[str, str]:
         """Obtain a list of all packages and versions installed on the system.
@@ -18,6 +18,7 @@
 
 import abc
 import contextlib
+import functools
 import logging
 import os
 from pathlib import Path
@@ -237,6 +238,7 @@ class DummyRepository(BaseRepository):
         """Unpack stage packages to install_path."""
 
 
+@functools.lru_cache(maxsize=4096)
 def get_pkg_name_parts(pkg_name: str) -> Tuple[str, Optional[str]]:
     """Break package name into base parts."""
     name = pkg_name
@@ -16,18 +16,31 @@
 
 """Support for deb files."""
 
-import fileinput
+import atexit
+import contextlib
 import functools
 import logging
 import os
 import pathlib
 import re
+import shutil
 import subprocess
-import sys
 import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import StringIO
 from pathlib import Path
-from typing import Dict, List, Optional, Sequence, Set, Tuple
+from typing import (
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 from craft_parts.utils import deb_utils, file_utils, os_utils
 
@@ -42,6 +55,9 @@ logger = logging.getLogger(__name__)
 # to fail appropriately on use instead. This implementation is
 # independent of the underlying host OS.
 try:
+    import apt_inst
+    import apt_pkg
+
     from .apt_cache import AptCache
 
     _APT_CACHE_AVAILABLE = True
@@ -53,6 +69,14 @@ except ImportError as import_error:
 
 
 _HASHSUM_MISMATCH_PATTERN = re.compile(r"(E:Failed to fetch.+Hash Sum mismatch)+")
+_DPKG_INFO_PATH = Path("/var/lib/dpkg/info")
+_LINK_MAX_WORKERS = 8
+_APT_ENV: Dict[str, str] = {
+    "DEBIAN_FRONTEND": "noninteractive",
+    "DEBCONF_NONINTERACTIVE_SEEN": "true",
+    "DEBIAN_PRIORITY": "critical",
+}
+_DPKG_LIST_INSTALLED_PATTERN = re.compile(rb"(?m)^ii[ \t]+(\S+)")
 _DEFAULT_FILTERED_STAGE_PACKAGES: List[str] = [
     "adduser",
     "apt",
@@ -165,93 +189,121 @@ _DEFAULT_FILTERED_STAGE_PACKAGES: List[str] = [
     "util-linux",
     "zlib1g",
 ]
+_DEFAULT_FILTERED_STAGE_PACKAGES_DEBS: Tuple[DebPackage, ...] = tuple(
+    DebPackage.from_unparsed(p) for p in _DEFAULT_FILTERED_STAGE_PACKAGES
+)
+
+
+IGNORE_FILTERS: Dict[str, FrozenSet[str]] = {
+    "core20": frozenset(
+        {
+            "python3-attr",
+            "python3-blinker",
+            "python3-certifi",
+            "python3-cffi-backend",
+            "python3-chardet",
+            "python3-configobj",
+            "python3-cryptography",
+            # Rely on setuptools installed by plugin or found in base, unless
+            # explicitly requested.
+            # "python3-distutils"
+            "python3-idna",
+            "python3-importlib-metadata",
+            "python3-jinja2",
+            "python3-json-pointer",
+            "python3-jsonpatch",
+            "python3-jsonschema",
+            "python3-jwt",
+            "python3-lib2to3",
+            "python3-markupsafe",
+            # Provides /usr/bin/python3, don't bring in unless explicitly requested.
+            # "python3-minimal"
+            "python3-more-itertools",
+            "python3-netifaces",
+            "python3-oauthlib",
+            # Rely on version brought in by setuptools, unless explicitly requested.
+            # "python3-pkg-resources"
+            "python3-pyrsistent",
+            "python3-pyudev",
+            "python3-requests",
+            "python3-requests-unixsocket",
+            "python3-serial",
+            # Rely on version installed by plugin or found in base, unless
+            # explicitly requested.
+            # "python3-setuptools"
+            "python3-six",
+            "python3-urllib3",
+            "python3-urwid",
+            "python3-yaml",
+            "python3-zipp",
+        }
+    ),
+    "core22": frozenset(
+        {
+            "python3-attr",
+            "python3-blinker",
+            "python3-certifi",
+            "python3-cffi-backend",
+            "python3-chardet",
+            "python3-configobj",
+            "python3-cryptography",
+            # Rely on setuptools installed by plugin or found in base, unless
+            # explicitly requested.
+            # "python3-distutils"
+            "python3-idna",
+            "python3-importlib-metadata",
+            "python3-jinja2",
+            "python3-json-pointer",
+            "python3-jsonpatch",
+            "python3-jsonschema",
+            "python3-jwt",
+            "python3-markupsafe",
+            # Provides /usr/bin/python3, don't bring in unless explicitly requested.
+            # "python3-minimal"
+            "python3-more-itertools",
+            "python3-netifaces",
+            "python3-oauthlib",
+            # Rely on version brought in by setuptools, unless explicitly requested.
+            # "python3-pkg-resources"
+            "python3-pyrsistent",
+            "python3-pyudev",
+            "python3-requests",
+            "python3-requests-unixsocket",
+            "python3-serial",
+            # Rely on version installed by plugin or found in base, unless
+            # explicitly requested.
+            # "python3-setuptools"
+            "python3-six",
+            "python3-urllib3",
+            "python3-urwid",
+            "python3-yaml",
+            "python3-zipp",
+        }
+    ),
+}
 
 
-IGNORE_FILTERS: Dict[str, Set[str]] = {
-    "core20": {
-        "python3-attr",
-        "python3-blinker",
-        "python3-certifi",
-        "python3-cffi-backend",
-        "python3-chardet",
-        "python3-configobj",
-        "python3-cryptography",
-        # Rely on setuptools installed by plugin or found in base, unless
-        # explicitly requested.
-        # "python3-distutils"
-        "python3-idna",
-        "python3-importlib-metadata",
-        "python3-jinja2",
-        "python3-json-pointer",
-        "python3-jsonpatch",
-        "python3-jsonschema",
-        "python3-jwt",
-        "python3-lib2to3",
-        "python3-markupsafe",
-        # Provides /usr/bin/python3, don't bring in unless explicitly requested.
-        # "python3-minimal"
-        "python3-more-itertools",
-        "python3-netifaces",
-        "python3-oauthlib",
-        # Rely on version brought in by setuptools, unless explicitly requested.
-        # "python3-pkg-resources"
-        "python3-pyrsistent",
-        "python3-pyudev",
-        "python3-requests",
-        "python3-requests-unixsocket",
-        "python3-serial",
-        # Rely on version installed by plugin or found in base, unless
-        # explicitly requested.
-        # "python3-setuptools"
-        "python3-six",
-        "python3-urllib3",
-        "python3-urwid",
-        "python3-yaml",
-        "python3-zipp",
-    },
-    "core22": {
-        "python3-attr",
-        "python3-blinker",
-        "python3-certifi",
-        "python3-cffi-backend",
-        "python3-chardet",
-        "python3-configobj",
-        "python3-cryptography",
-        # Rely on setuptools installed by plugin or found in base, unless
-        # explicitly requested.
-        # "python3-distutils"
-        "python3-idna",
-        "python3-importlib-metadata",
-        "python3-jinja2",
-        "python3-json-pointer",
-        "python3-jsonpatch",
-        "python3-jsonschema",
-        "python3-jwt",
-        "python3-markupsafe",
-        # Provides /usr/bin/python3, don't bring in unless explicitly requested.
-        # "python3-minimal"
-        "python3-more-itertools",
-        "python3-netifaces",
-        "python3-oauthlib",
-        # Rely on version brought in by setuptools, unless explicitly requested.
-        # "python3-pkg-resources"
-        "python3-pyrsistent",
-        "python3-pyudev",
-        "python3-requests",
-        "python3-requests-unixsocket",
-        "python3-serial",
-        # Rely on version installed by plugin or found in base, unless
-        # explicitly requested.
-        # "python3-setuptools"
-        "python3-six",
-        "python3-urllib3",
-        "python3-urwid",
-        "python3-yaml",
-        "python3-zipp",
-    },
+_SOURCE_TYPE_PACKAGES: Dict[str, FrozenSet[str]] = {
+    "bzr": frozenset({"bzr"}),
+    "git": frozenset({"git"}),
+    "tar": frozenset({"tar"}),
+    "hg": frozenset({"mercurial"}),
+    "mercurial": frozenset({"mercurial"}),
+    "svn": frozenset({"subversion"}),
+    "subversion": frozenset({"subversion"}),
+    "rpm2cpio": frozenset({"rpm2cpio"}),
+    "7zip": frozenset({"p7zip-full"}),
 }
 
 
+_HOST_APT_CACHE_LOCK = threading.Lock()
+_HOST_APT_CACHE: Optional["AptCache"] = None
+_HOST_APT_CACHE_USERS = 0
+
+_STAGE_APT_CACHES_LOCK = threading.Lock()
+_STAGE_APT_CACHES: Dict[Tuple[Path, str], "AptCache"] = {}
+
+
 def _apt_cache_wrapper(method):
     """Decorate a method to handle apt availability."""
 
@@ -264,39 +316,166 @@ def _apt_cache_wrapper(method):
     return wrapped
 
 
-@functools.lru_cache(maxsize=256)
-def _run_dpkg_query_search(file_path: str) -> str:
+@contextlib.contextmanager
+@_apt_cache_wrapper
+def _shared_host_apt_cache() -> Iterator["AptCache"]:
+    """Provide a host package cache shared by nested users.
+
+    The cache is opened by the outermost user and closed when the last user
+    exits, so batches of queries don't reopen it for every call.
+    """
+    global _HOST_APT_CACHE, _HOST_APT_CACHE_USERS  # pylint: disable=global-statement
+
+    with _HOST_APT_CACHE_LOCK:
+        if _HOST_APT_CACHE is None:
+            # pylint: disable=unnecessary-dunder-call
+            _HOST_APT_CACHE = AptCache().__enter__()
+        _HOST_APT_CACHE_USERS += 1
+        apt_cache = _HOST_APT_CACHE
+
     try:
-        output = (
-            subprocess.check_output(
-                ["dpkg-query", "-S", os.path.join(os.path.sep, file_path)],
-                stderr=subprocess.STDOUT,
-                env=dict(LANG="C.UTF-8"),
-            )
-            .decode()
-            .strip()
-        )
-    except subprocess.CalledProcessError as call_error:
-        logger.debug("Error finding package for %s: %s", file_path, str(call_error))
-        raise errors.FileProviderNotFound(file_path=file_path) from call_error
+        yield apt_cache
+    finally:
+        with _HOST_APT_CACHE_LOCK:
+            _HOST_APT_CACHE_USERS -= 1
+            if _HOST_APT_CACHE_USERS == 0:
+                _HOST_APT_CACHE = None
+                apt_cache.__exit__(None, None, None)
+
+
+def _stage_apt_cache(stage_cache: Path, stage_cache_arch: str) -> "AptCache":
+    """Return a stage package cache kept open until the package list is refreshed.
+
+    Callers must clear the cache marks before use, since the cache is shared
+    by all stage package fetches for the same cache directory and architecture.
+    """
+    key = (stage_cache, stage_cache_arch)
+    with _STAGE_APT_CACHES_LOCK:
+        apt_cache = _STAGE_APT_CACHES.get(key)
+        if apt_cache is None:
+            # pylint: disable=unnecessary-dunder-call
+            apt_cache = AptCache(
+                stage_cache=stage_cache, stage_cache_arch=stage_cache_arch
+            ).__enter__()
+            _STAGE_APT_CACHES[key] = apt_cache
+
+    return apt_cache
+
+
+@atexit.register
+def _close_stage_apt_caches() -> None:
+    """Close the stage package caches, so the next fetch reopens them."""
+    with _STAGE_APT_CACHES_LOCK:
+        for apt_cache in _STAGE_APT_CACHES.values():
+            apt_cache.__exit__(None, None, None)
+        _STAGE_APT_CACHES.clear()
+
+
+@functools.lru_cache(maxsize=1)
+def _dpkg_file_index() -> Dict[str, str]:
+    """Map the files installed on the host to the packages providing them.
+
+    The map is built in a single pass over the dpkg database file lists, so
+    lookups don't need to spawn a ``dpkg-query`` process for each file. Paths
+    diverted to other locations are not part of package file lists and are
+    not included.
+    """
+    index: Dict[str, str] = {}
+    for list_path in sorted(_DPKG_INFO_PATH.glob("*.list")):
+        # Multi-arch packages are listed as <name>:<arch>.list
+        package_name = list_path.stem.split(":")[0]
+        for entry in list_path.read_bytes().splitlines():
+            index.setdefault(os.fsdecode(entry), package_name)
+
+    return index
 
-    # Remove diversions
-    provides_output = [p for p in output.splitlines() if not p.startswith("diversion")][
-        0
-    ]
-    return provides_output.split(":")[0]
+
+@functools.lru_cache(maxsize=16384)
+def _run_dpkg_query_search_nullable(file_path: str) -> Optional[str]:
+    # Unlike exceptions, None results are memoized, so files not provided
+    # by any package are only looked up once.
+    return _dpkg_file_index().get(os.path.join(os.path.sep, file_path))
+
+
+def _run_dpkg_query_search(file_path: str) -> str:
+    package_name = _run_dpkg_query_search_nullable(file_path)
+    if package_name is None:
+        logger.debug("Error finding package for %s", file_path)
+        raise errors.FileProviderNotFound(file_path=file_path)
+
+    return package_name
 
 
 @functools.lru_cache(maxsize=256)
-def _run_dpkg_query_list_files(package_name: str) -> Set[str]:
-    output = (
-        subprocess.check_output(["dpkg", "-L", package_name])
-        .decode(sys.getfilesystemencoding())
-        .strip()
-        .split()
-    )
+def _read_package_libraries(package_name: str) -> Set[str]:
+    """Read the libraries of an installed package from the dpkg database.
 
-    return {i for i in output if ("lib" in i and os.path.isfile(i))}
+    :raises PackageNotFound: If no file list exists for the package.
+    """
+    list_paths = [_DPKG_INFO_PATH / f"{package_name}.list"]
+    if ":" not in package_name:
+        list_paths.extend(_DPKG_INFO_PATH.glob(f"{package_name}:*.list"))
+    list_paths = [path for path in list_paths if path.is_file()]
+    if not list_paths:
+        logger.debug("No dpkg file list found for %s", package_name)
+        raise errors.PackageNotFound(package_name)
+
+    return {
+        os.fsdecode(entry)
+        for list_path in list_paths
+        for entry in list_path.read_bytes().splitlines()
+        if b"lib" in entry and os.path.isfile(entry)
+    }
+
+
+def _link_or_copy_deb(source: str, destination: str) -> None:
+    """Hard-link a downloaded deb into place, copying it if linking fails.
+
+    The destination directory is known to exist, so the generic
+    :func:`file_utils.link_or_copy` checks are not needed.
+    """
+    try:
+        os.link(source, destination, follow_symlinks=False)
+    except OSError:
+        # Cross-device link, unsupported by the filesystem or not permitted.
+        shutil.copy2(source, destination)
+
+
+def _link_stage_debs(
+    archives: Iterable[Tuple[str, str, Path]], stage_packages_path: Path
+) -> Set[str]:
+    """Link archives into the stage packages dir while the next ones download.
+
+    :param archives: The name, version and path of each fetched archive.
+    :param stage_packages_path: The directory to link the archives into.
+
+    :return: The fetched packages, as <name>=<version> strings.
+    """
+    with os.scandir(stage_packages_path) as entries:
+        existing = {entry.name: entry.stat().st_size for entry in entries}
+
+    installed: Set[str] = set()
+    with ThreadPoolExecutor(max_workers=_LINK_MAX_WORKERS) as executor:
+        links: List[Future] = []
+        for pkg_name, pkg_version, dl_path in archives:
+            logger.debug("Extracting stage package: %s", pkg_name)
+            installed.add(f"{pkg_name}={pkg_version}")
+            # Deb file names include the package version, so a deb already
+            # present in the stage packages dir is current unless truncated.
+            destination = stage_packages_path / dl_path.name
+            size = existing.get(dl_path.name)
+            if size == dl_path.stat().st_size:
+                continue
+            if size is not None:
+                destination.unlink()
+            links.append(
+                executor.submit(_link_or_copy_deb, str(dl_path), str(destination))
+            )
+
+        for link in links:
+            link.result()
+
+    return installed
 
 
 def _get_dpkg_list_path(base: str) -> pathlib.Path:
@@ -307,19 +486,21 @@ def _get_filtered_stage_package_names(
     *, base: str, package_list: List[DebPackage]
 ) -> Set[str]:
     """Get filtered packages by name only - no version or architectures."""
-    manifest_packages = [p.name for p in get_packages_in_base(base=base)]
-    stage_packages = [p.name for p in package_list]
+    manifest_packages = {p.name for p in get_packages_in_base(base=base)}
+    stage_packages = {p.name for p in package_list}
 
-    return (
-        set(manifest_packages) - set(stage_packages) - IGNORE_FILTERS.get(base, set())
-    )
+    return manifest_packages - stage_packages - IGNORE_FILTERS.get(base, frozenset())
 
 
+@functools.lru_cache(maxsize=8)
 def get_packages_in_base(*, base: str) -> List[DebPackage]:
-    """Get the list of packages for the given base."""
+    """Get the list of packages for the given base.
+
+    The result is cached, callers must not modify the returned list.
+    """
     # We do not want to break what we already have.
     if base in ("core", "core16", "core18"):
-        return [DebPackage.from_unparsed(p) for p in _DEFAULT_FILTERED_STAGE_PACKAGES]
+        return list(_DEFAULT_FILTERED_STAGE_PACKAGES_DEBS)
 
     base_package_list_path = _get_dpkg_list_path(base)
     if not base_package_list_path.exists():
@@ -327,15 +508,11 @@ def get_packages_in_base(*, base: str) -> List[DebPackage]:
 
     # Lines we care about in dpkg.list had the following format:
     # ii adduser 3.118ubuntu1 all add and rem
-    package_list = []
-    with fileinput.input(str(base_package_list_path)) as file:
-        for line in file:
-            if not str(line).startswith("ii "):
-                continue
-            package = DebPackage.from_unparsed(str(line.split()[1]))
-            package_list.append(package)
-
-    return package_list
+    data = base_package_list_path.read_bytes()
+    return [
+        DebPackage.from_unparsed(match.group(1).decode())
+        for match in _DPKG_LIST_INSTALLED_PATTERN.finditer(data)
+    ]
 
 
 def _is_list_of_slices(names: List[str]) -> bool:
@@ -357,6 +534,7 @@ class Ubuntu(BaseRepository):
     """Repository management for Ubuntu packages."""
 
     @classmethod
+    @functools.lru_cache(maxsize=4)
     @_apt_cache_wrapper
     def configure(cls, application_package_name: str) -> None:
         """Set up apt options and directories."""
@@ -364,31 +542,34 @@ class Ubuntu(BaseRepository):
 
     @classmethod
     def get_package_libraries(cls, package_name: str) -> Set[str]:
-        """Return a list of libraries in package_name."""
-        return _run_dpkg_query_list_files(package_name)
+        """Return a list of libraries in package_name.
+
+        :raises PackageNotFound: If the package is not installed.
+        """
+        return cls.get_package_libraries_bulk([package_name])[package_name]
+
+    @classmethod
+    def get_package_libraries_bulk(
+        cls, package_names: Iterable[str]
+    ) -> Dict[str, Set[str]]:
+        """Return the libraries provided by each of the given packages.
+
+        The file lists are read directly from the dpkg database, so no
+        subprocess is spawned regardless of the number of packages.
+
+        :param package_names: The names of the installed packages to query.
+
+        :return: A dictionary mapping package names to their libraries.
+
+        :raises PackageNotFound: If any of the packages is not installed.
+        """
+        return {name: _read_package_libraries(name) for name in package_names}
 
     @classmethod
     @_apt_cache_wrapper
-    def get_packages_for_source_type(cls, source_type):
+    def get_packages_for_source_type(cls, source_type: str) -> Set[str]:
         """Return a list of packages required to to work with source_type."""
-        if source_type == "bzr":
-            packages = {"bzr"}
-        elif source_type == "git":
-            packages = {"git"}
-        elif source_type == "tar":
-            packages = {"tar"}
-        elif source_type in ["hg", "mercurial"]:
-            packages = {"mercurial"}
-        elif source_type == ["svn", "subversion"]:
-            packages = {"subversion"}
-        elif source_type == "rpm2cpio":
-            packages = {"rpm2cpio"}
-        elif source_type == "7zip":
-            packages = {"p7zip-full"}
-        else:
-            packages = set()
-
-        return packages
+        return set(_SOURCE_TYPE_PACKAGES.get(source_type, frozenset()))
 
     @classmethod
     @functools.lru_cache(maxsize=1)
@@ -407,9 +588,11 @@ class Ubuntu(BaseRepository):
                 "failed to run apt update"
             ) from call_error
 
+        # Stage caches opened before the update hold the stale package lists.
+        _close_stage_apt_caches()
+
     @classmethod
-    @_apt_cache_wrapper
-    def _check_if_all_packages_installed(cls, package_names: List[str]) -> bool:
+    def _check_installed(cls, apt_cache: "AptCache", package_names: List[str]) -> bool:
         """Check if all given packages are installed.
 
         Will check versions if using <pkg_name>=<pkg_version> syntax parsed by
@@ -418,17 +601,16 @@ class Ubuntu(BaseRepository):
 
         :return True if _all_ packages are installed (with correct versions).
         """
-        with AptCache() as apt_cache:
-            for package in package_names:
-                pkg_name, pkg_version = get_pkg_name_parts(package)
-                installed_version = apt_cache.get_installed_version(
-                    pkg_name, resolve_virtual_packages=True
-                )
+        for package in package_names:
+            pkg_name, pkg_version = get_pkg_name_parts(package)
+            installed_version = apt_cache.get_installed_version(
+                pkg_name, resolve_virtual_packages=True
+            )
 
-                if installed_version is None or (
-                    pkg_version is not None and installed_version != pkg_version
-                ):
-                    return False
+            if installed_version is None or (
+                pkg_version is not None and installed_version != pkg_version
+            ):
+                return False
 
         return True
 
@@ -437,7 +619,7 @@ class Ubuntu(BaseRepository):
     def _get_installed_package_versions(cls, package_names: Sequence[str]) -> List[str]:
         packages: List[str] = []
 
-        with AptCache() as apt_cache:
+        with _shared_host_apt_cache() as apt_cache:
             for package_name in package_names:
                 package_version = apt_cache.get_installed_version(
                     package_name, resolve_virtual_packages=True
@@ -455,30 +637,24 @@ class Ubuntu(BaseRepository):
         return packages
 
     @classmethod
-    @_apt_cache_wrapper
-    def _get_packages_marked_for_installation(
-        cls, package_names: List[str]
+    def _mark_for_install(
+        cls, apt_cache: "AptCache", package_names: List[str]
     ) -> List[Tuple[str, str]]:
-        with AptCache() as apt_cache:
-            try:
-                apt_cache.mark_packages(set(package_names))
-            except errors.PackageNotFound as error:
-                raise errors.BuildPackageNotFound(error.package_name)
+        # The host cache is shared, drop marks left by previous users.
+        apt_cache.clear_marks()
+        try:
+            apt_cache.mark_packages(set(package_names))
+        except errors.PackageNotFound as error:
+            raise errors.BuildPackageNotFound(error.package_name)
 
-            return apt_cache.get_packages_marked_for_installation()
+        return apt_cache.get_packages_marked_for_installation()
 
     @classmethod
     def download_packages(cls, package_names: List[str]) -> None:
         """Download the specified packages to the local package cache area."""
         logger.info("Downloading packages: %s", " ".join(package_names))
         env = os.environ.copy()
-        env.update(
-            {
-                "DEBIAN_FRONTEND": "noninteractive",
-                "DEBCONF_NONINTERACTIVE_SEEN": "true",
-                "DEBIAN_PRIORITY": "critical",
-            }
-        )
+        env.update(_APT_ENV)
 
         apt_command = [
             "apt-get",
@@ -507,45 +683,46 @@ class Ubuntu(BaseRepository):
         if not package_names:
             return []
 
-        install_required = False
         package_names = sorted(package_names)
 
         logger.debug("Requested build-packages: %s", package_names)
 
-        # Ensure we have an up-to-date cache first if we will have to
-        # install anything.
-        if not cls._check_if_all_packages_installed(package_names):
-            install_required = True
+        with _shared_host_apt_cache() as apt_cache:
+            # Ensure we have an up-to-date cache first if we will have to
+            # install anything.
+            install_required = not cls._check_installed(apt_cache, package_names)
 
-        # Collect the list of marked packages to later construct a manifest
-        marked_packages = cls._get_packages_marked_for_installation(package_names)
-        marked_package_names = [name for name, _ in sorted(marked_packages)]
-
-        if not list_only:
-            if refresh_package_cache and install_required:
-                cls.refresh_packages_list()
-            if install_required:
-                cls._install_packages(package_names)
-            else:
+            if not list_only and not install_required:
                 logger.debug(
                     "Requested build-packages already installed: %s", package_names
                 )
+                return cls._get_installed_package_versions(
+                    [get_pkg_name_parts(name)[0] for name in package_names]
+                )
+
+            # Collect the list of marked packages to later construct a manifest
+            marked_packages = cls._mark_for_install(apt_cache, package_names)
+            marked_package_names = [name for name, _ in sorted(marked_packages)]
+
+            if not list_only:
+                if refresh_package_cache:
+                    cls.refresh_packages_list()
+                cls._install_packages(package_names)
+                apt_cache.refresh()
+                # The dpkg database changed, drop what was read from it.
+                _dpkg_file_index.cache_clear()
+                _run_dpkg_query_search_nullable.cache_clear()
+                _read_package_libraries.cache_clear()
 
-        # This result is a best effort approach for deps and virtual packages
-        # as they are not part of the installation list.
-        return cls._get_installed_package_versions(marked_package_names)
+            # This result is a best effort approach for deps and virtual packages
+            # as they are not part of the installation list.
+            return cls._get_installed_package_versions(marked_package_names)
 
     @classmethod
     def _install_packages(cls, package_names: List[str]) -> None:
         logger.debug("Installing packages: %s", " ".join(package_names))
         env = os.environ.copy()
-        env.update(
-            {
-                "DEBIAN_FRONTEND": "noninteractive",
-                "DEBCONF_NONINTERACTIVE_SEEN": "true",
-                "DEBIAN_PRIORITY": "critical",
-            }
-        )
+        env.update(_APT_ENV)
 
         apt_command = [
             "apt-get",
@@ -618,29 +795,23 @@ class Ubuntu(BaseRepository):
         stage_cache_dir, deb_cache_dir = get_cache_dirs(cache_dir)
         deb_cache_dir.mkdir(parents=True, exist_ok=True)
 
-        installed: Set[str] = set()
-
         # Update the package cache
         cls.refresh_packages_list()
 
-        with AptCache(stage_cache=stage_cache_dir, stage_cache_arch=arch) as apt_cache:
-            apt_cache.mark_packages(set(package_names))
-            apt_cache.unmark_packages(filtered_names)
-
-            if list_only:
-                marked_packages = apt_cache.get_packages_marked_for_installation()
-                installed = {
-                    f"{name}={version}" for name, version in sorted(marked_packages)
-                }
-            else:
-                for pkg_name, pkg_version, dl_path in apt_cache.fetch_archives(
-                    deb_cache_dir
-                ):
-                    logger.debug("Extracting stage package: %s", pkg_name)
-                    installed.add(f"{pkg_name}={pkg_version}")
-                    file_utils.link_or_copy(
-                        str(dl_path), str(stage_packages_path / dl_path.name)
-                    )
+        apt_cache = _stage_apt_cache(stage_cache_dir, arch)
+        apt_cache.clear_marks()
+        apt_cache.mark_packages(set(package_names))
+        apt_cache.unmark_packages(filtered_names)
+
+        if list_only:
+            marked_packages = apt_cache.get_packages_marked_for_installation()
+            installed = {
+                f"{name}={version}" for name, version in sorted(marked_packages)
+            }
+        else:
+            installed = _link_stage_debs(
+                apt_cache.fetch_archives(deb_cache_dir), stage_packages_path
+            )
 
         return sorted(installed)
 
@@ -671,22 +842,59 @@ class Ubuntu(BaseRepository):
         stage_packages_path: pathlib.Path,
         install_path: pathlib.Path,
     ) -> None:
-        pkg_path = None
-
-        for pkg_path in stage_packages_path.glob("*.deb"):
-            with tempfile.TemporaryDirectory(
-                suffix="deb-extract", dir=install_path.parent
-            ) as extract_dir:
-                # Extract deb package.
-                deb_utils.extract_deb(pkg_path, Path(extract_dir), logger.debug)
-                # Mark source of files.
-                marked_name = cls._extract_deb_name_version(pkg_path)
-                mark_origin_stage_package(extract_dir, marked_name)
-                # Stage files to install_dir.
-                file_utils.link_or_copy_tree(extract_dir, install_path.as_posix())
-
-        if pkg_path:
-            normalize(install_path, repository=cls)
+        if not stage_packages_path.is_dir():
+            return
+
+        with os.scandir(stage_packages_path) as entries:
+            pkg_paths = [
+                Path(entry.path)
+                for entry in entries
+                if entry.name.endswith(".deb") and entry.is_file()
+            ]
+        if not pkg_paths:
+            return
+
+        with tempfile.TemporaryDirectory(
+            suffix="deb-extract", dir=install_path.parent
+        ) as extract_root:
+            extract_dirs = [Path(extract_root, str(i)) for i in range(len(pkg_paths))]
+            names = cls._extract_deb_names_versions(pkg_paths)
+            marked_names = [names[pkg_path] for pkg_path in pkg_paths]
+
+            # Extraction is done by dpkg-deb subprocesses and can run in
+            # parallel, but packages are staged in order so that files
+            # shared between packages are resolved deterministically.
+            max_workers = min(len(pkg_paths), os.cpu_count() or 4)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for extract_dir in executor.map(
+                    cls._extract_stage_deb, pkg_paths, extract_dirs, marked_names
+                ):
+                    # Stage files to install_dir.
+                    file_utils.link_or_copy_tree(
+                        str(extract_dir), install_path.as_posix()
+                    )
+                    shutil.rmtree(extract_dir)
+
+        normalize(install_path, repository=cls)
+
+    @classmethod
+    def _extract_stage_deb(
+        cls, pkg_path: Path, extract_dir: Path, marked_name: str
+    ) -> Path:
+        """Extract a deb package and mark the origin of its files.
+
+        :param pkg_path: The deb package to extract.
+        :param extract_dir: The directory to extract the package into.
+        :param marked_name: The package name and version to mark files with.
+
+        :return: The directory containing the extracted files.
+        """
+        extract_dir.mkdir()
+        # Extract deb package.
+        deb_utils.extract_deb(pkg_path, extract_dir, logger.debug)
+        # Mark source of files.
+        mark_origin_stage_package(str(extract_dir), marked_name)
+        return extract_dir
 
     @classmethod
     def _unpack_stage_slices(
@@ -722,19 +930,45 @@ class Ubuntu(BaseRepository):
     @_apt_cache_wrapper
     def is_package_installed(cls, package_name) -> bool:
         """Inform if a package is installed on the host system."""
-        with AptCache() as apt_cache:
+        with _shared_host_apt_cache() as apt_cache:
             return apt_cache.get_installed_version(package_name) is not None
 
     @classmethod
     @_apt_cache_wrapper
     def get_installed_packages(cls) -> List[str]:
         """Obtain a list of the installed packages and their versions."""
-        with AptCache() as apt_cache:
+        with _shared_host_apt_cache() as apt_cache:
             return [
                 f"{pkg_name}={pkg_version}"
                 for pkg_name, pkg_version in apt_cache.get_installed_packages().items()
             ]
 
+    @classmethod
+    def _extract_deb_names_versions(cls, deb_paths: List[Path]) -> Dict[Path, str]:
+        """Obtain the name and version of the given deb packages.
+
+        The package control data is read in-process if python-apt is available,
+        otherwise dpkg-deb is called for each package.
+
+        :param deb_paths: The deb packages to query.
+
+        :return: A dictionary mapping each deb path to <name>=<version>.
+        """
+        if not _APT_CACHE_AVAILABLE:
+            return {path: cls._extract_deb_name_version(path) for path in deb_paths}
+
+        names: Dict[Path, str] = {}
+        for deb_path in deb_paths:
+            try:
+                control = apt_pkg.TagSection(
+                    apt_inst.DebFile(str(deb_path)).control.extractdata("control")
+                )
+                names[deb_path] = f"{control['Package']}={control['Version']}"
+            except (apt_pkg.Error, LookupError) as err:
+                raise errors.UnpackError(str(deb_path)) from err
+
+        return names
+
     @classmethod
     def _extract_deb_name_version(cls, deb_path: pathlib.Path) -> str:
         try:
@@ -201,6 +201,51 @@ class TestMockedApt:
             call.cache.Cache().close(),
         ]
 
+    def test_host_cache_refresh(self, mocker):
+        fake_apt = mocker.patch("craft_parts.packages.apt_cache.apt")
+
+        with AptCache() as cache:
+            cache.refresh()
+
+        assert fake_apt.mock_calls == [
+            call.cache.Cache(rootdir="/"),
+            call.cache.Cache().close(),
+            call.cache.Cache(rootdir="/"),
+            call.cache.Cache().close(),
+        ]
+
+    def test_clear_marks(self, mocker):
+        fake_apt = mocker.patch("craft_parts.packages.apt_cache.apt")
+
+        with AptCache() as cache:
+            cache.clear_marks()
+
+        assert fake_apt.mock_calls == [
+            call.cache.Cache(rootdir="/"),
+            call.cache.Cache().clear(),
+            call.cache.Cache().close(),
+        ]
+
+    def test_fetch_archives_is_lazy(self, tmpdir, mocker):
+        fake_apt = mocker.patch("craft_parts.packages.apt_cache.apt")
+        fake_package = mocker.Mock()
+        fake_package.name = "fake-package"
+        fake_package.candidate.version = "1.0"
+        fake_package.candidate.fetch_binary.return_value = "/fake-package.deb"
+        fake_apt.cache.Cache.return_value.get_changes.return_value = [
+            fake_package,
+            fake_package,
+        ]
+
+        with AptCache() as cache:
+            archives = cache.fetch_archives(Path(tmpdir))
+            fake_package.candidate.fetch_binary.assert_not_called()
+
+            assert next(archives) == ("fake-package", "1.0", Path("/fake-package.deb"))
+            fake_package.candidate.fetch_binary.assert_called_once_with(
+                str(tmpdir), progress=None
+            )
+
 
 class TestAptReadonlyHostCache:
     """Host cache tests."""
@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import contextlib
+import errno
 import subprocess
 import textwrap
 from pathlib import Path
@@ -41,7 +42,7 @@ def mock_env_copy():
 @pytest.fixture
 def fake_all_packages_installed(mocker):
     mocker.patch(
-        "craft_parts.packages.deb.Ubuntu._check_if_all_packages_installed",
+        "craft_parts.packages.deb.Ubuntu._check_installed",
         return_value=False,
     )
 
@@ -58,6 +59,16 @@ def apt_update_cache():
     deb.Ubuntu.refresh_packages_list.cache_clear()
 
 
+@pytest.fixture(autouse=True)
+def packages_in_base_cache():
+    deb.get_packages_in_base.cache_clear()
+
+
+@pytest.fixture(autouse=True)
+def stage_apt_cache():
+    deb._STAGE_APT_CACHES.clear()
+
+
 @pytest.fixture(autouse=True)
 def cache_dirs(mocker, tmpdir):
     stage_cache_path = Path(tmpdir, "stage-cache")
@@ -109,12 +120,25 @@ def test_fake_wrapper_apt_unavailable(monkeypatch):
     assert fake_ubuntu.apt_called is False
 
 
+def test_configure(fake_apt_cache):
+    deb.Ubuntu.configure.cache_clear()
+
+    deb.Ubuntu.configure("test-app")
+    deb.Ubuntu.configure("test-app")
+    deb.Ubuntu.configure("other-app")
+
+    assert fake_apt_cache.configure_apt.mock_calls == [
+        call("test-app"),
+        call("other-app"),
+    ]
+
+
 class TestPackages:
     def test_fetch_stage_packages(self, mocker, tmpdir, fake_apt_cache, fake_deb_run):
         # pylint: disable=unnecessary-dunder-call
         mocker.patch(
-            "craft_parts.packages.deb._DEFAULT_FILTERED_STAGE_PACKAGES",
-            {"filtered-pkg-1", "filtered-pkg-2"},
+            "craft_parts.packages.deb._DEFAULT_FILTERED_STAGE_PACKAGES_DEBS",
+            (DebPackage("filtered-pkg-1"), DebPackage("filtered-pkg-2")),
         )
 
         stage_cache_path, debs_path = deb.get_cache_dirs(tmpdir)
@@ -137,6 +161,7 @@ class TestPackages:
             [
                 call(stage_cache=stage_cache_path, stage_cache_arch="amd64"),
                 call().__enter__(),
+                call().__enter__().clear_marks(),
                 call().__enter__().mark_packages({"fake-package"}),
                 call()
                 .__enter__()
@@ -147,6 +172,54 @@ class TestPackages:
 
         assert fetched_packages == ["fake-package=1.0"]
 
+    def test_fetch_stage_packages_reuses_cache(
+        self, tmpdir, fake_apt_cache, fake_deb_run
+    ):
+        stage_cache_path, _ = deb.get_cache_dirs(tmpdir)
+        fake_apt_cache.return_value.__enter__.return_value.fetch_archives.return_value = (
+            []
+        )
+
+        for name in ("fake-package", "other-fake-package"):
+            deb.Ubuntu.fetch_stage_packages(
+                cache_dir=tmpdir,
+                package_names=[name],
+                stage_packages_path=Path(tmpdir),
+                base="core",
+                arch="amd64",
+            )
+
+        fake_apt_cache.assert_called_once_with(
+            stage_cache=stage_cache_path, stage_cache_arch="amd64"
+        )
+        cache = fake_apt_cache.return_value.__enter__.return_value
+        assert cache.clear_marks.call_count == 2
+        assert cache.mark_packages.mock_calls == [
+            call({"fake-package"}),
+            call({"other-fake-package"}),
+        ]
+
+    def test_fetch_stage_packages_after_refresh(
+        self, tmpdir, fake_apt_cache, fake_deb_run
+    ):
+        fake_apt_cache.return_value.__enter__.return_value.fetch_archives.return_value = (
+            []
+        )
+
+        for _ in range(2):
+            deb.Ubuntu.refresh_packages_list.cache_clear()
+            deb.Ubuntu.fetch_stage_packages(
+                cache_dir=tmpdir,
+                package_names=["fake-package"],
+                stage_packages_path=Path(tmpdir),
+                base="core",
+                arch="amd64",
+            )
+
+        assert fake_apt_cache.call_count == 2
+        cache = fake_apt_cache.return_value.__enter__.return_value
+        cache.__exit__.assert_called_once_with(None, None, None)
+
     def test_fetch_virtual_stage_package(self, tmpdir, fake_apt_cache, fake_deb_run):
         _, debs_path = deb.get_cache_dirs(tmpdir)
         fake_package = debs_path / "fake-package_1.0_all.deb"
@@ -190,6 +263,82 @@ class TestPackages:
             ["fake-package=1.0", "fake-package-dep=2.0"]
         )
 
+    def test_fetch_stage_package_skip_existing(
+        self, tmpdir, fake_apt_cache, fake_deb_run
+    ):
+        _, debs_path = deb.get_cache_dirs(tmpdir)
+        stage_packages_path = Path(tmpdir, "stage-packages")
+        stage_packages_path.mkdir()
+        fake_package = debs_path / "fake-package_1.0_all.deb"
+        fake_package.write_text("new")
+        fake_package_dep = debs_path / "fake-package-dep_1.0_all.deb"
+        fake_package_dep.write_text("dep")
+        Path(stage_packages_path, fake_package.name).write_text("old")
+        fake_apt_cache.return_value.__enter__.return_value.fetch_archives.return_value = [
+            ("fake-package", "1.0", fake_package),
+            ("fake-package-dep", "2.0", fake_package_dep),
+        ]
+
+        fetched_packages = deb.Ubuntu.fetch_stage_packages(
+            cache_dir=tmpdir,
+            package_names=["fake-package"],
+            stage_packages_path=stage_packages_path,
+            base="core",
+            arch="amd64",
+        )
+
+        assert fetched_packages == ["fake-package-dep=2.0", "fake-package=1.0"]
+        assert Path(stage_packages_path, fake_package.name).read_text() == "old"
+        assert Path(stage_packages_path, fake_package_dep.name).read_text() == "dep"
+
+    def test_fetch_stage_package_replace_truncated(
+        self, tmpdir, fake_apt_cache, fake_deb_run
+    ):
+        _, debs_path = deb.get_cache_dirs(tmpdir)
+        stage_packages_path = Path(tmpdir, "stage-packages")
+        stage_packages_path.mkdir()
+        fake_package = debs_path / "fake-package_1.0_all.deb"
+        fake_package.write_text("content")
+        Path(stage_packages_path, fake_package.name).write_text("cont")
+        fake_apt_cache.return_value.__enter__.return_value.fetch_archives.return_value = [
+            ("fake-package", "1.0", fake_package),
+        ]
+
+        deb.Ubuntu.fetch_stage_packages(
+            cache_dir=tmpdir,
+            package_names=["fake-package"],
+            stage_packages_path=stage_packages_path,
+            base="core",
+            arch="amd64",
+        )
+
+        assert Path(stage_packages_path, fake_package.name).read_text() == "content"
+
+    def test_fetch_stage_package_copy_fallback(
+        self, tmpdir, mocker, fake_apt_cache, fake_deb_run
+    ):
+        _, debs_path = deb.get_cache_dirs(tmpdir)
+        stage_packages_path = Path(tmpdir, "stage-packages")
+        stage_packages_path.mkdir()
+        fake_package = debs_path / "fake-package_1.0_all.deb"
+        fake_package.write_text("content")
+        fake_apt_cache.return_value.__enter__.return_value.fetch_archives.return_value = [
+            ("fake-package", "1.0", fake_package),
+        ]
+        mocker.patch("os.link", side_effect=OSError(errno.EXDEV, "cross-device link"))
+
+        deb.Ubuntu.fetch_stage_packages(
+            cache_dir=tmpdir,
+            package_names=["fake-package"],
+            stage_packages_path=stage_packages_path,
+            base="core",
+            arch="amd64",
+        )
+
+        staged = Path(stage_packages_path, fake_package.name)
+        assert staged.read_text() == "content"
+        assert staged.stat().st_ino != fake_package.stat().st_ino
+
     def test_fetch_stage_package_empty_list(self, tmpdir, fake_apt_cache):
         fake_apt_cache.return_value.__enter__.return_value.fetch_archives.return_value = (
             []
@@ -238,6 +387,100 @@ class TestPackages:
 
         mock_normalize.assert_not_called()
 
+    def test_unpack_stage_packages_missing_dir(self, tmpdir, mocker):
+        install_path = Path(tmpdir, "install")
+        install_path.mkdir()
+        mock_normalize = mocker.patch("craft_parts.packages.deb.normalize")
+
+        deb.Ubuntu.unpack_stage_packages(
+            stage_packages_path=Path(tmpdir, "missing"), install_path=install_path
+        )
+
+        mock_normalize.assert_not_called()
+
+    def test_unpack_stage_packages(self, tmpdir, mocker):
+        packages_path = Path(tmpdir, "pkg")
+        install_path = Path(tmpdir, "install")
+        packages_path.mkdir()
+        install_path.mkdir()
+        for name in ("pkg1", "pkg2", "pkg3"):
+            Path(packages_path, f"{name}_1.0_all.deb").touch()
+        # Only deb files are unpacked.
+        Path(packages_path, "not-a-deb.txt").touch()
+        Path(packages_path, "dir.deb").mkdir()
+
+        def fake_extract_deb(deb_path, extract_dir, log_func):
+            name = deb_path.name.split("_")[0]
+            Path(extract_dir, "usr", "share", name).mkdir(parents=True)
+            Path(extract_dir, "usr", "share", name, "file").write_text(name)
+
+        mocker.patch(
+            "craft_parts.utils.deb_utils.extract_deb", side_effect=fake_extract_deb
+        )
+        mocker.patch(
+            "craft_parts.packages.deb.Ubuntu._extract_deb_names_versions",
+            side_effect=lambda paths: {p: p.name.split("_")[0] + "=1.0" for p in paths},
+        )
+        mock_mark_origin = mocker.patch(
+            "craft_parts.packages.deb.mark_origin_stage_package"
+        )
+        mock_normalize = mocker.patch("craft_parts.packages.deb.normalize")
+
+        deb.Ubuntu.unpack_stage_packages(
+            stage_packages_path=packages_path, install_path=install_path
+        )
+
+        for name in ("pkg1", "pkg2", "pkg3"):
+            assert Path(install_path, "usr", "share", name, "file").read_text() == name
+        assert sorted(c.args[1] for c in mock_mark_origin.mock_calls) == [
+            "pkg1=1.0",
+            "pkg2=1.0",
+            "pkg3=1.0",
+        ]
+        mock_normalize.assert_called_once_with(install_path, repository=deb.Ubuntu)
+
+    def test_extract_deb_names_versions(self, mocker):
+        mock_apt_inst = mocker.patch("craft_parts.packages.deb.apt_inst")
+        mock_apt_inst.DebFile.return_value.control.extractdata.side_effect = [
+            b"Package: pkg1\nVersion: 1.0\n",
+            b"Package: pkg2\nVersion: 2.0\n",
+        ]
+        mock_check_output = mocker.patch("subprocess.check_output")
+
+        names = deb.Ubuntu._extract_deb_names_versions(
+            [Path("pkg1_1.0_all.deb"), Path("pkg2_2.0_all.deb")]
+        )
+
+        assert names == {
+            Path("pkg1_1.0_all.deb"): "pkg1=1.0",
+            Path("pkg2_2.0_all.deb"): "pkg2=2.0",
+        }
+        assert mock_apt_inst.DebFile.mock_calls[0] == call("pkg1_1.0_all.deb")
+        mock_check_output.assert_not_called()
+
+    def test_extract_deb_names_versions_error(self, tmpdir):
+        deb_path = Path(tmpdir, "bad_1.0_all.deb")
+        deb_path.write_text("not a deb")
+
+        with pytest.raises(errors.UnpackError):
+            deb.Ubuntu._extract_deb_names_versions([deb_path])
+
+    def test_extract_deb_names_versions_no_apt(self, mocker, monkeypatch):
+        monkeypatch.setattr(deb, "_APT_CACHE_AVAILABLE", False)
+        mock_check_output = mocker.patch(
+            "subprocess.check_output", side_effect=[b"pkg1=1.0", b"pkg2=2.0"]
+        )
+
+        names = deb.Ubuntu._extract_deb_names_versions(
+            [Path("pkg1_1.0_all.deb"), Path("pkg2_2.0_all.deb")]
+        )
+
+        assert names == {
+            Path("pkg1_1.0_all.deb"): "pkg1=1.0",
+            Path("pkg2_2.0_all.deb"): "pkg2=2.0",
+        }
+        assert mock_check_output.call_count == 2
+
     def test_download_packages(self, fake_apt_cache, fake_deb_run):
         deb.Ubuntu.refresh_packages_list()
         deb.Ubuntu.download_packages(["package", "versioned-package=2.0"])
@@ -267,6 +510,25 @@ class TestPackages:
         )
 
 
+@pytest.mark.parametrize(
+    "source_type,packages",
+    [
+        ("bzr", {"bzr"}),
+        ("git", {"git"}),
+        ("tar", {"tar"}),
+        ("hg", {"mercurial"}),
+        ("mercurial", {"mercurial"}),
+        ("svn", {"subversion"}),
+        ("subversion", {"subversion"}),
+        ("rpm2cpio", {"rpm2cpio"}),
+        ("7zip", {"p7zip-full"}),
+        ("local", set()),
+    ],
+)
+def test_get_packages_for_source_type(source_type, packages):
+    assert deb.Ubuntu.get_packages_for_source_type(source_type) == packages
+
+
 class TestBuildPackages:
     @pytest.mark.usefixtures("fake_all_packages_installed")
     def test_install_build_packages(self, fake_apt_cache, fake_deb_run):
@@ -465,6 +727,68 @@ class TestBuildPackages:
             deb.Ubuntu.install_packages(["package=1.0"])
         assert raised.value.packages == ["package=1.0"]
 
+    @pytest.mark.usefixtures("fake_all_packages_installed")
+    def test_install_build_packages_shared_cache(self, fake_apt_cache, fake_deb_run):
+        fake_apt_cache.return_value.__enter__.return_value.get_packages_marked_for_installation.return_value = [
+            ("package", "1.0")
+        ]
+
+        deb.Ubuntu.install_packages(["package"])
+
+        fake_apt_cache.return_value.__enter__.return_value.refresh.assert_called_once_with()
+
+    def test_install_build_packages_all_installed(self, fake_apt_cache, fake_deb_run):
+        build_packages = deb.Ubuntu.install_packages(
+            ["package-installed=1.0", "versioned-package"]
+        )
+
+        assert build_packages == ["package-installed=1.0", "versioned-package=2.0"]
+        fake_apt_cache.assert_called_once_with()
+        fake_apt_cache.return_value.__enter__.return_value.mark_packages.assert_not_called()
+        fake_deb_run.assert_not_called()
+
+    def test_install_build_packages_all_installed_list_only(
+        self, fake_apt_cache, fake_deb_run
+    ):
+        fake_apt_cache.return_value.__enter__.return_value.get_packages_marked_for_installation.return_value = [
+            ("package-installed", "1.0"),
+        ]
+
+        build_packages = deb.Ubuntu.install_packages(
+            ["package-installed"], list_only=True
+        )
+
+        assert build_packages == ["package-installed=1.0"]
+        fake_apt_cache.assert_called_once_with()
+        fake_apt_cache.return_value.__enter__.return_value.mark_packages.assert_called_once_with(
+            {"package-installed"}
+        )
+        fake_deb_run.assert_not_called()
+
+    def test_shared_host_apt_cache(self, fake_apt_cache):
+        with deb._shared_host_apt_cache() as cache:
+            assert deb.Ubuntu.is_package_installed("package-installed")
+            assert deb.Ubuntu._check_installed(cache, ["package-installed"])
+
+        fake_apt_cache.assert_called_once_with()
+        assert cache == fake_apt_cache.return_value.__enter__.return_value
+        cache.__exit__.assert_called_once_with(None, None, None)
+
+    def test_shared_host_apt_cache_clears_marks(self, fake_apt_cache, fake_deb_run):
+        with deb._shared_host_apt_cache() as cache:
+            deb.Ubuntu.install_packages(["package"], list_only=True)
+            deb.Ubuntu.install_packages(["other-package"], list_only=True)
+
+        marks = [
+            c for c in cache.method_calls if c[0] in ("clear_marks", "mark_packages")
+        ]
+        assert marks == [
+            call.clear_marks(),
+            call.mark_packages({"package"}),
+            call.clear_marks(),
+            call.mark_packages({"other-package"}),
+        ]
+
     def test_refresh_packages_list(self, fake_deb_run):
         deb.Ubuntu.refresh_packages_list()
 
@@ -482,25 +806,67 @@ class TestBuildPackages:
 
 
 @pytest.fixture
-def fake_dpkg_query(mocker):
-    def dpkg_query(*args, **kwargs):
-        # dpkg-query -S file_path
-        if args[0][2] == "/bin/bash":
-            return "bash: /bin/bash\n".encode()
+def fake_dpkg_info(mocker, tmpdir):
+    info_path = Path(tmpdir, "dpkg-info")
+    info_path.mkdir()
+    Path(info_path, "bash.list").write_text("/.\n/bin\n/bin/bash\n")
+    Path(info_path, "dash.list").write_text("/.\n/bin\n/bin/dash\n/bin/sh\n")
+    Path(info_path, "libc6:amd64.list").write_text(
+        "/.\n/lib\n/lib/x86_64-linux-gnu/libc.so.6\n"
+    )
+    Path(info_path, "dash.md5sums").write_text("")
 
-        if args[0][2] == "/bin/sh":
-            return (
-                "diversion by dash from: /bin/sh\n"
-                "diversion by dash to: /bin/sh.distrib\n"
-                "dash: /bin/sh\n"
-            ).encode()
+    mocker.patch("craft_parts.packages.deb._DPKG_INFO_PATH", info_path)
+    deb._dpkg_file_index.cache_clear()
+    deb._run_dpkg_query_search_nullable.cache_clear()
+    yield info_path
+    deb._dpkg_file_index.cache_clear()
+    deb._run_dpkg_query_search_nullable.cache_clear()
 
-        raise CalledProcessError(
-            1,
-            f"dpkg-query: no path found matching pattern {args[0][2]}",
-        )
 
-    mocker.patch("subprocess.check_output", side_effect=dpkg_query)
+@pytest.mark.usefixtures("fake_dpkg_info")
+class TestDpkgQuerySearch:
+    def test_search(self):
+        assert deb._run_dpkg_query_search("bin/bash") == "bash"
+        assert deb._run_dpkg_query_search("/bin/sh") == "dash"
+
+    def test_search_multiarch(self):
+        assert deb._run_dpkg_query_search("/lib/x86_64-linux-gnu/libc.so.6") == "libc6"
+
+    def test_search_not_found(self):
+        with pytest.raises(errors.FileProviderNotFound) as raised:
+            deb._run_dpkg_query_search("/bin/sh.distrib")
+        assert raised.value.file_path == "/bin/sh.distrib"
+
+    def test_search_not_found_is_cached(self):
+        for _ in range(2):
+            with pytest.raises(errors.FileProviderNotFound):
+                deb._run_dpkg_query_search("/bin/sh.distrib")
+
+        cache_info = deb._run_dpkg_query_search_nullable.cache_info()
+        assert cache_info.misses == 1
+        assert cache_info.hits == 1
+
+    def test_index_built_once(self, mocker):
+        spy = mocker.spy(Path, "read_bytes")
+
+        deb._run_dpkg_query_search("/bin/bash")
+        deb._run_dpkg_query_search("/bin/dash")
+
+        assert spy.call_count == 3
+
+    @pytest.mark.usefixtures("fake_all_packages_installed", "fake_deb_run")
+    def test_search_after_install(self, fake_dpkg_info, fake_apt_cache):
+        fake_apt_cache.return_value.__enter__.return_value.get_packages_marked_for_installation.return_value = [
+            ("zsh", "5.8")
+        ]
+        with pytest.raises(errors.FileProviderNotFound):
+            deb._run_dpkg_query_search("/bin/zsh")
+
+        Path(fake_dpkg_info, "zsh.list").write_text("/.\n/bin\n/bin/zsh\n")
+        deb.Ubuntu.install_packages(["zsh"])
+
+        assert deb._run_dpkg_query_search("/bin/zsh") == "zsh"
 
 
 class TestGetPackagesInBase:
@@ -554,6 +920,17 @@ class TestGetPackagesInBase:
 
         assert deb.get_packages_in_base(base="core22") == []
 
+    def test_package_list_is_cached(self, tmpdir, mocker):
+        dpkg_list_path = Path(tmpdir, "dpkg.list")
+        dpkg_list_path.write_text("ii  adduser  3.118ubuntu1  all  add and rem\n")
+        mock_get_dpkg_list_path = mocker.patch(
+            "craft_parts.packages.deb._get_dpkg_list_path", return_value=dpkg_list_path
+        )
+
+        assert deb.get_packages_in_base(base="core22") == [DebPackage("adduser")]
+        assert deb.get_packages_in_base(base="core22") == [DebPackage("adduser")]
+        mock_get_dpkg_list_path.assert_called_once_with("core22")
+
 
 def test_get_filtered_stage_package_restricts_core20_ignore_filter(mocker):
     mock_get_packages_in_base = mocker.patch.object(deb, "get_packages_in_base")
@@ -610,3 +987,43 @@ def test_get_filtered_stage_package_empty_ignore_filter(mocker):
     )
 
     assert filtered_names == {"some-base-pkg", "some-other-base-pkg"}
+
+
+@pytest.mark.usefixtures("fake_dpkg_info")
+class TestGetPackageLibraries:
+    @pytest.fixture(autouse=True)
+    def fake_isfile(self, mocker):
+        deb._read_package_libraries.cache_clear()
+        yield mocker.patch("os.path.isfile", side_effect=lambda p: b"." in p)
+        deb._read_package_libraries.cache_clear()
+
+    def test_get_package_libraries(self):
+        assert deb.Ubuntu.get_package_libraries("libc6") == {
+            "/lib/x86_64-linux-gnu/libc.so.6"
+        }
+
+    def test_get_package_libraries_with_arch(self):
+        assert deb.Ubuntu.get_package_libraries("libc6:amd64") == {
+            "/lib/x86_64-linux-gnu/libc.so.6"
+        }
+
+    def test_get_package_libraries_bulk(self):
+        assert deb.Ubuntu.get_package_libraries_bulk(["bash", "libc6"]) == {
+            "bash": set(),
+            "libc6": {"/lib/x86_64-linux-gnu/libc.so.6"},
+        }
+
+    def test_get_package_libraries_not_installed(self):
+        with pytest.raises(errors.PackageNotFound) as raised:
+            deb.Ubuntu.get_package_libraries_bulk(["bash", "missing"])
+
+        assert raised.value.package_name == "missing"
+
+    def test_get_package_libraries_no_subprocess(self, mocker):
+        mock_run = mocker.patch("subprocess.run")
+        mock_check_output = mocker.patch("subprocess.check_output")
+
+        deb.Ubuntu.get_package_libraries_bulk(["bash", "dash", "libc6"])
+
+        mock_run.assert_not_called()
+        mock_check_output.assert_not_called()